@@ -133,7 +133,7 @@ def start_dedicated_server(name, plugin, _version=None, _priority=0, _schema=[])
         priority = _priority
 
     mod = Module(name, module=mod)
-    ps.plugins[name] = mod
+    ps.add_plugin(name, mod)
 
     if args.dump:
         ret = ps.get_plugin_info(name)
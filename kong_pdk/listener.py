@@ -64,15 +64,15 @@ class Server(object):
 
             cmd_r = cmd[0].lower() + cmdre.sub(lambda m: "%s_%s" % (m.group(1), m.group(2).lower()), cmd[1:])
             try:
-                self.logger.debug("rpc: #%d method: %s args: %s" % (msgid, method, args))
+                self.logger.debug("rpc: #%d method: %s args: %s", msgid, method, args)
                 ret = getattr(self.ps, cmd_r)(*args)
-                self.logger.debug("rpc: #%d return: %s" % (msgid, ret))
+                self.logger.debug("rpc: #%d return: %s", msgid, ret)
                 write_response(fd, msgid, ret)
             except (PluginServerException, PDKException) as ex:
-                self.logger.warn("rpc: #%d error: %s" % (msgid, str(ex)))
+                self.logger.warn("rpc: #%d error: %s", msgid, str(ex))
                 write_error(fd, msgid, str(ex))
             except Exception as ex:
-                self.logger.error("rpc: #%d exception: %s" % (msgid, traceback.format_exc()))
+                self.logger.error("rpc: #%d exception: %s", msgid, traceback.format_exc())
                 write_error(fd, msgid, str(ex))
 
 class tUnixStreamServer(ThreadingMixIn, sUnixStreamServer):
@@ -28,6 +28,9 @@ else:
         sys.modules[name] = mod
         return mod
 
+# expiry is tracked with a monotonic clock to be immune to wall clock jumps
+monotonic = getattr(time, 'monotonic', time.time)
+
 phases = ("certificate", "rewrite", "log", "access", "preread", "response")
 
 class Module(object):
@@ -67,6 +70,23 @@ class Module(object):
         self.last_start_instance_time = 0
         self.last_close_instance_time = 0
 
+        # returned as is by get_plugin_info
+        self.info = {
+            "Name": name,
+            "Phases": self.phases,
+            "Priority": self.priority,
+            "Version": self.version,
+            "Schema": {
+                "name": name,
+                "fields": [{
+                    "config": {
+                        "type": "record",
+                        "fields": self.schema,
+                    }
+                }],
+            },
+        }
+
     def new(self, config):
         self.last_start_instance_time = time.time()
         return Instance(self.name, config, self.cls, self.set_last_close_instance_time)
@@ -81,13 +101,14 @@ class Instance(object):
         self.name = name
         self.config = config
         self.start_time = time.time()
+        self.start_ts = monotonic()
         self.last_used_time = 0
         self.close_cb = close_cb
 
     def is_expired(self, ttl=60):
-        until = time.time() - ttl
-        return self.start_time < until and self.last_used_time < until
+        until = monotonic() - ttl
+        return self.start_ts < until and self.last_used_time < until
 
     def reset_expire_ts(self):
-        self.last_used_time = time.time()
+        self.last_used_time = monotonic()
         return self.cls
@@ -1,6 +1,8 @@
 import os
 import time
-import json
+import socket
+import traceback
+from operator import attrgetter
 
 from .const import PY3K
 
@@ -11,51 +13,101 @@ else:
     from Queue import Queue
 
 import multiprocessing
-# patch connection API so it share with gevent.queue.Channel
-if PY3K:
-    from multiprocessing import connection
-    connection.Connection.get = connection.Connection.recv
-    connection.Connection.put = connection.Connection.send
+import msgpack
+
+# neither the event handlers nor the cleanup timer use spawn_tree_locals or
+# spawning_greenlet, skip tracking them to make spawning cheaper
+if 'GEVENT_TRACK_GREENLET_TREE' not in os.environ:
+    os.environ['GEVENT_TRACK_GREENLET_TREE'] = '0'
 
-from gevent import sleep as gsleep, spawn as gspawn
+from gevent import sleep as gsleep, spawn_raw as gspawn_raw
 from gevent.lock import Semaphore as gSemaphore
-from gevent.queue import Channel as gChannel
+from gevent.queue import Queue as gQueue
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 try:
     import setproctitle
 except:  # noqa: E722 do not use bare 'except
     setproctitle = None
 
-from .pdk import Kong
+from .pdk import Kong, non_return_methods
 from .module import Module
 from .exception import PluginServerException
 from .logger import Logger
 
-exts = ('.py', '.pyd', '.so')
-entities = ('service', 'consumer', 'route', 'plugin', 'credential', 'memory_stats')
+exts = frozenset(('.py', '.pyd', '.so'))
 
 MSG_RET = 'ret'
 
+# replied to PDK calls a plugin makes after kong.response.exit or error
+MSG_EXITED = 'request has already exited'
+
+# an event id is a slot index in its low bits and a generation, bumped each
+# time the slot is reused, above them; ids stay below 2^53 so they're exact
+# as Lua numbers
+EVENT_SLOT_BITS = 20
+EVENT_SLOT_MASK = (1 << EVENT_SLOT_BITS) - 1
+EVENT_ID_LIMIT = 1 << 53
+
+# upper bound of the default number of multiprocess workers
+MAX_DEFAULT_POOL_SIZE = 16
+
+# buffer size of worker pipes, large enough to carry request/response bodies
+# without the peer having to drain it in several rounds
+PIPE_BUFSIZE = 256 * 1024
+
 def locked_by(lock_name):
+    get_lock = attrgetter(lock_name)
+
     def f(fn):
-        def wrapper(*args, **kwargs):
-            self = args[0]
-            lock = getattr(self, lock_name)
-            lock.acquire()
-            try:
-                r = fn(*args, **kwargs)
-            except Exception as ex:
-                lock.release()
-                raise ex
-            lock.release()
-            return r
+        def wrapper(self, *args, **kwargs):
+            with get_lock(self):
+                return fn(self, *args, **kwargs)
         return wrapper
 
     return f
 
 def _handler_event_func(cls_phase, ch, lua_style):
-    cls_phase(Kong(ch, lua_style).kong)
-    ch.put(MSG_RET)
+    try:
+        cls_phase(Kong(ch, lua_style).kong)
+    finally:
+        # the server waits for it, also when the handler raises
+        ch.put(MSG_RET)
+
+class _Channel(object):
+    """
+    The get/put interface the PDK and the event handlers talk over, bound
+    once to the methods of the underlying transport
+    """
+    def __init__(self, get, put):
+        self.get = get
+        self.put = put
+
+    @classmethod
+    def of_queues(cls, queue_cls, *args):
+        # a pair of ends, what is put() on one end is get() from the other
+        up, down = queue_cls(*args), queue_cls(*args)
+        return cls(up.get, down.put), cls(down.get, up.put)
+
+    @classmethod
+    def of_connection(cls, conn):
+        # what goes through the channel is sent to or received from Kong
+        # anyway, so it's packed with msgpack instead of being pickled
+        return cls(lambda: msgpack.unpackb(conn.recv_bytes(), strict_map_key=False),
+                   lambda data: conn.send_bytes(msgpack.packb(data)))
+
+def _list_files(path):
+    # returns (name, path) of the files in a directory, the directory is
+    # closed before any of them is loaded
+    if not hasattr(os, 'scandir'):  # python 2
+        files = ((p, os.path.join(path, p)) for p in os.listdir(path))
+        return [(p, full) for p, full in files if os.path.isfile(full)]
+    with os.scandir(path) as it:
+        return [(e.name, e.path) for e in it if e.is_file()]
 
 def _multiprocessing_init(pool_name):
     p = multiprocessing.current_process()
@@ -63,11 +115,98 @@ def _multiprocessing_init(pool_name):
     if setproctitle:
         setproctitle.setproctitle(p.name)
 
+def _worker_loop(ch, lua_style, pool_name):
+    _multiprocessing_init(pool_name)
+    # plugin instances are sent once per worker and cached here by instance id
+    instances = {}
+    # the pipe is the same for every event, so is the PDK talking over it
+    pdk_ch = _Channel.of_connection(ch)
+    kong = Kong(pdk_ch, lua_style).kong
+    while True:
+        try:
+            iid, ins, phase, stale = ch.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        for s in stale:
+            instances.pop(s, None)
+        if ins is not None:
+            instances[iid] = ins
+        try:
+            getattr(instances[iid], phase)(kong)
+        except Exception:
+            traceback.print_exc()
+        pdk_ch.put(MSG_RET)
+
+def _enlarge_pipe_buffer(ch, size):
+    # duplex Pipe is a socketpair on posix, fromfd dups the fd so closing
+    # the socket object won't affect the connection
+    if os.name != 'posix':
+        return
+    s = socket.fromfd(ch.fileno(), socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    except (OSError, socket.error):
+        pass
+    finally:
+        s.close()
+
+class _Worker(object):
+    """
+    A long-lived process holding one end of a pre-created duplex Pipe; it
+    exposes get/put so it can be used in place of a channel of an event
+    """
+    def __init__(self, lua_style, pool_name):
+        self.ch, child_ch = multiprocessing.Pipe(duplex=True)
+        pdk_ch = _Channel.of_connection(self.ch)
+        self.get = pdk_ch.get
+        self.put = pdk_ch.put
+        for c in (self.ch, child_ch):
+            _enlarge_pipe_buffer(c, PIPE_BUFSIZE)
+        # iids and stale are changed by handle_event under e_lock and by
+        # instance removal under i_lock, so they have their own lock
+        self.lock = threading.Lock()
+        self.iids = set()
+        self.stale = []
+        self.tasks = 0
+        self.process = multiprocessing.Process(
+            target=_worker_loop,
+            args=(child_ch, lua_style, pool_name, ),
+        )
+        self.process.daemon = True
+        self.process.start()
+        child_ch.close()
+
+    def dispatch(self, iid, ins, phase):
+        with self.lock:
+            cached = iid in self.iids
+            # the message is pickled before anything is written, nothing is
+            # recorded unless it's sent
+            self.ch.send((iid, None if cached else ins, phase, self.stale))
+            if not cached:
+                self.iids.add(iid)
+            self.stale = []
+            self.tasks += 1
+
+    def evict(self, iid):
+        with self.lock:
+            if iid in self.iids:
+                self.iids.discard(iid)
+                self.stale.append(iid)
+
+    def terminate(self):
+        self.process.terminate()
+        self.process.join()
+        self.ch.close()
+
 class PluginServer(object):
     def __init__(self, loglevel=Logger.WARNING, expire_ttl=60, plugin_dir=None,
-                 use_multiprocess=False, use_gevent=False, name=None, lua_style=True):
+                 use_multiprocess=False, use_gevent=False, name=None, lua_style=True,
+                 pool_size=None, max_tasks_per_worker=10000):
         if use_multiprocess:
-            sem = multiprocessing.Semaphore
+            # the locks only guard state of this process, workers are only
+            # reached through their pipes; no need for a cross process lock
+            sem = threading.Lock
         elif use_gevent:
             sem = gSemaphore
         else:
@@ -78,10 +217,20 @@ class PluginServer(object):
         self.instances = {}
         self.instance_id = 0
         self.i_lock = sem()
-        self.events = {}
-        self.event_id = 0
+        # event ids are short lived, they index into a list of channels and
+        # the slots are reused once the event is finished; the current id of
+        # each slot rejects steps for a previous event in the same slot
+        self._event_slots = []
+        self._event_ids = []
+        self._free_slots = []
         self.e_lock = sem()
 
+        # bumped whenever self.plugins or self.instances are changed, to
+        # invalidate the cached get_status response
+        self._plugins_version = 0
+        self._instances_version = 0
+        self._status_cache = None
+
         self.logger = Logger()
         self.logger.set_level(loglevel)
 
@@ -101,11 +250,7 @@ class PluginServer(object):
             if not PY3K:
                 raise NotImplementedError("multiprocessing mode is only supported in Python3")
 
-            self._process_pool = multiprocessing.Pool(
-                os.cpu_count(),
-                _multiprocessing_init,
-                (title, ),
-            )
+            self._start_workers(title, pool_size, max_tasks_per_worker)
             self.logger.debug("plugin server is in multiprocessing mode")
 
         # start cleanup timer
@@ -128,6 +273,37 @@ class PluginServer(object):
             else:
                 setproctitle.setproctitle("%s (ppid: %d)" % (title, ppid))
 
+    def _start_workers(self, title, pool_size, max_tasks_per_worker):
+        if not pool_size:
+            pool_size = min(os.cpu_count() or 4, MAX_DEFAULT_POOL_SIZE)
+        self._title = title
+        self._max_tasks_per_worker = max_tasks_per_worker
+        self._workers = [_Worker(self.lua_style, title) for _ in range(pool_size)]
+        # guards self._workers, which is changed when a worker is replaced
+        # and walked when an instance is evicted
+        self._w_lock = threading.Lock()
+        self._closing = False
+        self._free_workers = Queue()
+        for w in self._workers:
+            self._free_workers.put(w)
+
+    def _replace_worker(self, worker):
+        with self._w_lock:
+            if self._closing:
+                # still in self._workers, cleanup terminates it
+                return
+            try:
+                new = _Worker(self.lua_style, self._title)
+            except Exception as ex:
+                # keep using the old one, it's retried after its next event
+                self.logger.error("error replacing worker %d: %s", worker.process.pid, ex)
+                self._free_workers.put(worker)
+                return
+            self._workers[self._workers.index(worker)] = new
+        worker.terminate()
+        self.logger.debug("worker %d retired after %d events", worker.process.pid, worker.tasks)
+        self._free_workers.put(new)
+
     def _clear_expired_plugins(self, ttl):
         while True:
             if self.use_gevent:
@@ -135,35 +311,54 @@ class PluginServer(object):
             else:
                 time.sleep(ttl)
 
-            self.i_lock.acquire()
-            keys = list(self.instances.keys())
-            for iid in keys:
-                instance = self.instances[iid]
-                if instance.is_expired(ttl):
-                    self.logger.debug("cleanup instance #%d of %s" % (iid, instance.name))
+            # scan a snapshot without holding the lock, only take it to
+            # remove each expired instance
+            expired = [iid for iid, ins in list(self.instances.items())
+                       if ins.is_expired(ttl)]
+            for iid in expired:
+                with self.i_lock:
+                    instance = self.instances.get(iid)
+                    # might be used again since the snapshot is taken
+                    if instance is None or not instance.is_expired(ttl):
+                        continue
+                    self.logger.debug("cleanup instance #%d of %s", iid, instance.name)
                     del self.instances[iid]
-            self.i_lock.release()
+                    self._instances_version += 1
+                    self._evict_instance(iid)
+
+    def _evict_instance(self, iid):
+        if self.use_multiprocess:
+            with self._w_lock:
+                for w in self._workers:
+                    w.evict(iid)
 
     def cleanup(self):
         if self.use_multiprocess:
-            self._process_pool.terminate()
-            self._process_pool.join()
+            with self._w_lock:
+                self._closing = True
+                for w in self._workers:
+                    w.terminate()
 
     def _load_plugins(self):
         if not self.plugin_dir:
             raise PluginServerException("plugin server is not initialized, call SetPluginDir first")
 
-        for p in os.listdir(self.plugin_dir):
-            n, ext = os.path.splitext(p)
-            if ext in exts:
-                path = os.path.join(self.plugin_dir, p)
+        for p, path in _list_files(self.plugin_dir):
+            dot = p.rfind('.')
+            # a leading dot marks a hidden file rather than an extension
+            if dot > 0 and p[dot:] in exts:
+                n = p[:dot]
                 try:
                     mod = Module(n, path=path)
                 except Exception as ex:
-                    self.logger.warn("error loading plugin \"%s\": %s" % (n, ex))
+                    self.logger.warn("error loading plugin \"%s\": %s", n, ex)
                 else:
-                    self.logger.debug("loaded plugin \"%s\" from %s" % (n, path))
-                    self.plugins[n] = mod
+                    self.logger.debug("loaded plugin \"%s\" from %s", n, path)
+                    self.add_plugin(n, mod)
+
+    def add_plugin(self, name, mod):
+        self.plugins[name] = mod
+        self._plugins_version += 1
 
     def set_plugin_dir(self, dir):
         if not os.path.exists(dir):
@@ -173,63 +368,59 @@ class PluginServer(object):
 
     @locked_by("i_lock")
     def get_status(self, *_):
+        version = (self._plugins_version, self._instances_version)
+        if self._status_cache and self._status_cache[0] == version:
+            return self._status_cache[1]
+
+        by_plugin = dict((name, []) for name in self.plugins)
+        for iid, ins in self.instances.items():
+            instances = by_plugin.get(ins.name)
+            if instances is not None:
+                instances.append({
+                    "Name": ins.name,
+                    "Id": iid,
+                    "Config": ins.config,
+                    "StartTime": ins.start_time,
+                })
+
         plugin_status = {}
-        for name in self.plugins:
-            instances = []
-            for iid in self.instances:
-                if self.instances[iid].name == name:
-                    i = self.instance_status(iid)
-                    instances.append(i)
-            plugin = self.plugins[name]
+        for name, plugin in self.plugins.items():
             plugin_status[name] = {
                 "Name": name,
                 "Modtime": plugin.mtime,
                 "LoadTime": plugin.load_time,
-                "Instances": instances,
+                "Instances": by_plugin[name],
                 "LastStartInstance": plugin.last_start_instance_time,
                 "LastCloseInstance": plugin.last_close_instance_time,
             }
-        return {
+        status = {
             "Pid": os.getpid(),
             "Plugins": plugin_status,
         }
+        self._status_cache = (version, status)
+        return status
 
     def get_plugin_info(self, name):
-        if name not in self.plugins:
-            raise PluginServerException("%s not initizlied" % name)
-
-        plugin = self.plugins[name]
+        plugin = self.plugins.get(name)
+        if plugin is None:
+            raise PluginServerException("plugin \"%s\" not initialized" % name)
 
-        info = {
-            "Name": name,
-            "Phases": plugin.phases,
-            "Priority": plugin.priority,
-            "Version": plugin.version,
-            "Schema": {
-                "name": name,
-                "fields": [{
-                    "config": {
-                        "type": "record",
-                        "fields": plugin.schema,
-                    }
-                }],
-            },
-        }
-        return info
+        return plugin.info
 
     @locked_by("i_lock")
     def start_instance(self, cfg):
         name = cfg['Name']
         if name not in self.plugins:
-            raise PluginServerException("%s not initizlied" % name)
+            raise PluginServerException("plugin \"%s\" not initialized" % name)
         plugin = self.plugins[name]
 
-        config = json.loads(cfg['Config'])
+        config = json_loads(cfg['Config'])
         iid = self.instance_id
         self.instances[iid] = plugin.new(config)
         self.instance_id = iid + 1
+        self._instances_version += 1
 
-        self.logger.info("instance #%d of %s started" % (iid, name))
+        self.logger.info("instance #%d of %s started", iid, name)
 
         return {
             "Name": name,
@@ -239,12 +430,11 @@ class PluginServer(object):
         }
 
     def instance_status(self, iid):
-        if iid not in self.instances:
+        ins = self.instances.get(iid)
+        if ins is None:
             # Note: Kong expect the error to start with "no plugin instance"
             raise PluginServerException("no plugin instance #%s" % iid)
 
-        ins = self.instances[iid]
-
         return {
             "Name": ins.name,
             "Id": iid,
@@ -254,13 +444,14 @@ class PluginServer(object):
 
     @locked_by("i_lock")
     def close_instance(self, iid):
-        if iid not in self.instances:
+        ins = self.instances.pop(iid, None)
+        if ins is None:
             # Note: Kong expect the error to start with "no plugin instance"
             raise PluginServerException("no plugin instance #%s" % iid)
 
-        ins = self.instances[iid]
         ins.close_cb()
-        del self.instances[iid]
+        self._instances_version += 1
+        self._evict_instance(iid)
 
         return {
             "Name": ins.name,
@@ -271,74 +462,135 @@ class PluginServer(object):
     @locked_by("e_lock")
     def handle_event(self, event):
         iid = event['InstanceId']
-        if iid not in self.instances:
+        instance = self.instances.get(iid)
+        if instance is None:
             # Note: Kong expect the error to start with "no plugin instance"
             raise PluginServerException("no plugin instance #%s" % iid)
 
-        instance = self.instances[iid]
         instance.reset_expire_ts()
         cls = instance.cls
         phase = event['EventName']
-
-        eid = self.event_id
-        self.event_id = eid + 1
+        # raises for an unknown phase in every mode, before any dispatching
+        cls_phase = getattr(cls, phase)
 
         if self.use_multiprocess:
-            ch, child_ch = multiprocessing.Pipe(duplex=True)
-            self.events[eid] = ch
-            self._process_pool.apply_async(
-                _handler_event_func,
-                (getattr(cls, phase), child_ch, self.lua_style, ),
-            )
+            ch = self._free_workers.get()
+            try:
+                ch.dispatch(iid, cls, phase)
+            except Exception:
+                self._free_workers.put(ch)
+                raise
+            # the instance might be closed after it's looked up above, and
+            # its eviction have missed this worker
+            if iid not in self.instances:
+                ch.evict(iid)
         elif self.use_gevent:
             # plugin communites to Kong (RPC client) in a reverse way
-            ch = gChannel()
-            self.events[eid] = ch
+            # the two sides strictly take turns, so one slot each way is enough
+            # and put() doesn't need to wait for the peer to get()
+            ch, child_ch = _Channel.of_queues(gQueue, 1)
 
-            gspawn(_handler_event_func,
-                   getattr(cls, phase), ch, self.lua_style,
-                   )
+            gspawn_raw(_handler_event_func,
+                       cls_phase, child_ch, self.lua_style,
+                       )
         else:  # normal threading mode
-            ch = Queue()
-            child_ch = Queue()
-            ch.get, child_ch.get = child_ch.get, ch.get
-            self.events[eid] = ch
+            ch, child_ch = _Channel.of_queues(Queue)
             t = threading.Thread(
                 target=_handler_event_func,
-                args=(getattr(cls, phase), child_ch, self.lua_style, ),
+                args=(cls_phase, child_ch, self.lua_style, ),
             )
             t.setDaemon(True)
             t.start()
 
+        eid = self._new_event(ch)
+
         r = ch.get()
         instance.reset_expire_ts()
 
+        self._check_event_end(eid, ch, r)
+
         return {
             "Data": r,
             "EventId": eid,
         }
 
-    def _step(self, data, is_error):
-        eid = data['EventId']
-        if eid not in self.events:
-            raise PluginServerException("event id %s not found" % eid)
-        dd = None
-        if 'Data' in data:
-            dd = data['Data']
-        ch = self.events[eid]
-        if is_error:
-            ch.put((
-                None, dd
-            ))
+    def _new_event(self, ch):
+        # only called from handle_event, which is serialized by e_lock
+        if self._free_slots:
+            slot = self._free_slots.pop()
+            self._event_slots[slot] = ch
+            return self._event_ids[slot]
+        slot = len(self._event_slots)
+        self._event_slots.append(ch)
+        self._event_ids.append(slot)
+        return slot
+
+    def _check_event_end(self, eid, ch, r):
+        if r == MSG_RET:
+            self._end_event(eid, ch)
+        elif isinstance(r, dict) and r.get("Method") in non_return_methods:
+            # the plugin doesn't wait for a reply of those and Kong won't
+            # step this event again; stop accepting steps for it right away,
+            # and read until the phase handler returns in the background so
+            # that MSG_RET doesn't stay in the channel
+            self._event_slots[eid & EVENT_SLOT_MASK] = None
+            self._spawn(self._drain_event, eid, ch)
+
+    def _spawn(self, fn, *args):
+        if self.use_gevent:
+            gspawn_raw(fn, *args)
         else:
-            ch.put((
-                dd, None
-            ))
+            t = threading.Thread(target=fn, args=args)
+            t.daemon = True
+            t.start()
 
+    def _drain_event(self, eid, ch):
+        while True:
+            try:
+                r = ch.get()
+            except (EOFError, OSError):
+                # the worker is terminated by cleanup
+                return
+            if r == MSG_RET:
+                break
+            if r.get("Method") not in non_return_methods:
+                ch.put((None, MSG_EXITED))
+        self._release_event(eid, ch)
+
+    def _end_event(self, eid, ch):
+        self._event_slots[eid & EVENT_SLOT_MASK] = None
+        self._release_event(eid, ch)
+
+    def _release_event(self, eid, ch):
+        slot = eid & EVENT_SLOT_MASK
+        self._event_ids[slot] = (eid + (1 << EVENT_SLOT_BITS)) % EVENT_ID_LIMIT
+        self._free_slots.append(slot)
+        if self.use_multiprocess:
+            if self._max_tasks_per_worker and ch.tasks >= self._max_tasks_per_worker:
+                # fork the replacement off the RPC path, the worker is back
+                # in the pool once it's started
+                t = threading.Thread(target=self._replace_worker, args=(ch, ))
+                t.daemon = True
+                t.start()
+            else:
+                self._free_workers.put(ch)
+
+    def _step(self, eid, msg):
+        try:
+            slot = eid & EVENT_SLOT_MASK
+        except TypeError:  # not an integer
+            slot = -1
+        if 0 <= slot < len(self._event_ids) and self._event_ids[slot] == eid:
+            ch = self._event_slots[slot]
+        else:
+            ch = None
+        if ch is None:
+            raise PluginServerException("event id %s not found" % eid)
+
+        ch.put(msg)
         ret = ch.get()
 
-        if ret == MSG_RET:
-            del self.events[eid]
+        self._check_event_end(eid, ch, ret)
 
         return {
             "Data": ret,
@@ -346,13 +598,10 @@ class PluginServer(object):
         }
 
     def step(self, data):
-        return self._step(data, False)
+        return self._step(data['EventId'], (data.get('Data'), None))
 
     def step_error(self, data):
-        return self._step(data, True)
-
-
-for entity in entities:
-    setattr(PluginServer, 'step_' + entity, PluginServer.step)
+        return self._step(data['EventId'], (None, data.get('Data')))
 
-setattr(PluginServer, 'step_multi_map', PluginServer.step)
+    step_service = step_consumer = step_route = step_plugin = step
+    step_credential = step_memory_stats = step_multi_map = step
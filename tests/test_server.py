@@ -0,0 +1,196 @@
+import os
+import threading
+import unittest
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+from kong_pdk.exception import PluginServerException
+from kong_pdk.module import Module
+from kong_pdk.server import PluginServer
+
+
+class ExitPlugin(object):
+    def __init__(self, config):
+        self.config = config
+
+    def access(self, kong):
+        kong.response.exit(403, "forbidden")
+        # anything called after exit gets an error reply
+        _, err = kong.request.get_header("host")
+        kong.response.set_header("x-err", err)
+
+
+class PythonStyleExitPlugin(object):
+    def __init__(self, config):
+        self.config = config
+
+    def access(self, kong):
+        kong.response.exit(403, "forbidden")
+        # raises PDKException as the request has already exited
+        kong.log.info("after exit")
+
+
+class GetHeaderPlugin(object):
+    def __init__(self, config):
+        self.config = config
+
+    def access(self, kong):
+        kong.request.get_header("host")
+
+
+class PidPlugin(object):
+    def __init__(self, config):
+        self.config = config
+
+    def access(self, kong):
+        kong.response.exit(200, os.getpid())
+
+
+class UnpicklablePlugin(object):
+    def __init__(self, config):
+        self.lock = threading.Lock()
+
+    def access(self, kong):
+        pass
+
+
+def make_module(name, plugin):
+    class mod(object):
+        Plugin = plugin
+        Schema = []
+        version = None
+        priority = 0
+
+    return Module(name, module=mod)
+
+
+class TestResponseExit(unittest.TestCase):
+    def run_server(self, plugin=ExitPlugin, **kwargs):
+        ps = PluginServer(**kwargs)
+        self.addCleanup(ps.cleanup)
+        ps.add_plugin("exit", make_module("exit", plugin))
+        iid = ps.start_instance({"Name": "exit", "Config": "{}"})["Id"]
+
+        results = []
+
+        def events():
+            for _ in range(3):
+                results.append(ps.handle_event({"InstanceId": iid, "EventName": "access"}))
+
+        # a leaked worker or channel would block the next event forever
+        t = threading.Thread(target=events)
+        t.daemon = True
+        t.start()
+        t.join(10)
+        self.assertFalse(t.is_alive(), "handle_event blocked after kong.response.exit")
+        self.assertEqual(len(results), 3)
+
+        for r in results:
+            self.assertEqual(r["Data"]["Method"], "kong.response.exit")
+            self.assertEqual(list(r["Data"]["Args"]), [403, "forbidden"])
+            # the event is finished, Kong won't step it again
+            self.assertRaises(Exception, ps.step, {"EventId": r["EventId"], "Data": None})
+        return ps
+
+    def test_threading(self):
+        self.run_server()
+
+    def test_gevent(self):
+        self.run_server(use_gevent=True)
+
+    def test_multiprocess(self):
+        ps = self.run_server(use_multiprocess=True, pool_size=1)
+        # the worker is released once the last event is drained
+        w = ps._free_workers.get(timeout=10)
+        # nothing is left in the worker pipe
+        self.assertFalse(w.ch.poll(0.1))
+
+    def test_python_style_threading(self):
+        self.run_server(PythonStyleExitPlugin, lua_style=False)
+
+    def test_python_style_gevent(self):
+        self.run_server(PythonStyleExitPlugin, lua_style=False, use_gevent=True)
+
+    def test_python_style_multiprocess(self):
+        self.run_server(PythonStyleExitPlugin, lua_style=False, use_multiprocess=True, pool_size=1)
+
+
+class TestMultiprocessDispatch(unittest.TestCase):
+    def test_dispatch_error_keeps_worker(self):
+        ps = PluginServer(use_multiprocess=True, pool_size=1)
+        self.addCleanup(ps.cleanup)
+        ps.add_plugin("unpicklable", make_module("unpicklable", UnpicklablePlugin))
+        iid = ps.start_instance({"Name": "unpicklable", "Config": "{}"})["Id"]
+
+        for _ in range(2):
+            self.assertRaises(TypeError, ps.handle_event, {"InstanceId": iid, "EventName": "access"})
+            self.assertEqual(ps._free_workers.qsize(), 1)
+            self.assertEqual(ps._workers[0].iids, set())
+
+    def test_unknown_phase(self):
+        ps = PluginServer(use_multiprocess=True, pool_size=1)
+        self.addCleanup(ps.cleanup)
+        ps.add_plugin("pid", make_module("pid", PidPlugin))
+        iid = ps.start_instance({"Name": "pid", "Config": "{}"})["Id"]
+
+        self.assertRaises(AttributeError, ps.handle_event, {"InstanceId": iid, "EventName": "log"})
+        self.assertEqual(ps._free_workers.qsize(), 1)
+
+    def test_worker_is_replaced(self):
+        ps = PluginServer(use_multiprocess=True, pool_size=1, max_tasks_per_worker=2)
+        self.addCleanup(ps.cleanup)
+        ps.add_plugin("pid", make_module("pid", PidPlugin))
+        iid = ps.start_instance({"Name": "pid", "Config": "{}"})["Id"]
+
+        pids = []
+        for _ in range(5):
+            r = ps.handle_event({"InstanceId": iid, "EventName": "access"})
+            pids.append(r["Data"]["Args"][1])
+        self.assertEqual(len(set(pids)), 3)
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+
+    def test_failed_replacement_keeps_worker(self):
+        ps = PluginServer(use_multiprocess=True, pool_size=1, max_tasks_per_worker=1)
+        self.addCleanup(ps.cleanup)
+        ps.add_plugin("pid", make_module("pid", PidPlugin))
+        iid = ps.start_instance({"Name": "pid", "Config": "{}"})["Id"]
+
+        def fail(*_):
+            raise OSError("no more fds")
+
+        with mock.patch("kong_pdk.server._Worker", side_effect=fail):
+            pids = [ps.handle_event({"InstanceId": iid, "EventName": "access"})["Data"]["Args"][1]
+                    for _ in range(2)]
+        self.assertEqual(pids[0], pids[1])
+        self.assertEqual(len(ps._workers), 1)
+
+
+class TestStep(unittest.TestCase):
+    def test_unknown_event_id(self):
+        ps = PluginServer()
+        for eid in (0, -1, "0", None, 1.0):
+            with self.assertRaises(PluginServerException) as cm:
+                ps.step({"EventId": eid, "Data": None})
+            self.assertEqual(str(cm.exception), "event id %s not found" % eid)
+
+    def test_stale_event_id(self):
+        ps = PluginServer()
+        ps.add_plugin("get", make_module("get", GetHeaderPlugin))
+        get_iid = ps.start_instance({"Name": "get", "Config": "{}"})["Id"]
+
+        r = ps.handle_event({"InstanceId": get_iid, "EventName": "access"})
+        old = ps.step({"EventId": r["EventId"], "Data": "host"})
+        self.assertEqual(old["Data"], "ret")
+
+        # the slot is reused by the next event, under a different id
+        r = ps.handle_event({"InstanceId": get_iid, "EventName": "access"})
+        self.assertNotEqual(r["EventId"], old["EventId"])
+        self.assertRaises(PluginServerException, ps.step, {"EventId": old["EventId"], "Data": None})
+        self.assertEqual(ps.step({"EventId": r["EventId"], "Data": "host"})["Data"], "ret")
+
+
+if __name__ == "__main__":
+    unittest.main()